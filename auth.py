@@ -1,12 +1,62 @@
-import json
 import os
+import threading
+from functools import lru_cache
 
 import google.oauth2
+import orjson
+from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 
 SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
 OAUTH2_CREDENTIALS = "credentials.json"
 
+# Loaded credentials per data_dir, so repeated calls do not re-read the file.
+_credentials_cache = {}
+_credentials_lock = threading.Lock()
+
+# The last credentials JSON written per file, to skip rewriting unchanged tokens.
+_written_credentials = {}
+
+
+def save_credentials(credentials_file: str, credentials) -> None:
+    """
+    Writes the credentials to the given file unless they are unchanged since the last
+    write. The file is replaced atomically, so readers never see a partial write.
+
+    Args:
+        credentials_file (str): The path of the file to write.
+        credentials (google.oauth2.credentials.Credentials): The credentials to write.
+
+    Returns:
+        None
+    """
+
+    credentials_json = credentials.to_json()
+    if _written_credentials.get(credentials_file) == credentials_json:
+        return
+
+    tmp_file = f"{credentials_file}.tmp"
+    with open(tmp_file, "w") as f:
+        f.write(credentials_json)
+    os.replace(tmp_file, credentials_file)
+    _written_credentials[credentials_file] = credentials_json
+
+
+@lru_cache(maxsize=None)
+def get_flow() -> InstalledAppFlow:
+    """
+    Creates the OAuth flow from the client secrets in credentials.json. The flow is
+    only needed to log in and is created at most once.
+
+    Returns:
+        InstalledAppFlow: The OAuth flow.
+    """
+
+    if not os.path.exists(OAUTH2_CREDENTIALS):
+        raise ValueError("credentials.json not found")
+
+    return InstalledAppFlow.from_client_secrets_file(OAUTH2_CREDENTIALS, SCOPES)
+
 
 def get_credentials(data_dir: str) -> google.oauth2.credentials.Credentials:
     """
@@ -20,21 +70,29 @@ def get_credentials(data_dir: str) -> google.oauth2.credentials.Credentials:
         google.oauth2.credentials.Credentials: The authentication credentials.
     """
 
-    if not os.path.exists(OAUTH2_CREDENTIALS):
-        raise ValueError("credentials.json not found")
+    with _credentials_lock:
+        credentials = _credentials_cache.get(data_dir)
+        if credentials is not None and credentials.valid:
+            return credentials
+
+        credentials_file = f"{data_dir}/credentials.json"
+        if not os.path.exists(credentials_file):
+            credentials = get_flow().run_local_server(port=0)
+        else:
+            with open(credentials_file, "rb") as f:
+                credentials_dict = orjson.loads(f.read())
+            credentials = (
+                google.oauth2.credentials.Credentials.from_authorized_user_info(
+                    credentials_dict
+                )
+            )
+            _written_credentials[credentials_file] = credentials.to_json()
+
+            # Refresh an expired token once here instead of in every API client.
+            if credentials.expired and credentials.refresh_token:
+                credentials.refresh(Request())
+
+        save_credentials(credentials_file, credentials)
 
-    flow = InstalledAppFlow.from_client_secrets_file(OAUTH2_CREDENTIALS, SCOPES)
-
-    credentials_file = f"{data_dir}/credentials.json"
-    if not os.path.exists(credentials_file):
-        credentials = flow.run_local_server(port=0)
-        with open(credentials_file, "w") as f:
-            f.write(credentials.to_json())
-    else:
-        with open(credentials_file, "r") as f:
-            credentials_dict = json.load(f)
-        credentials = google.oauth2.credentials.Credentials.from_authorized_user_info(
-            credentials_dict
-        )
-
-    return credentials
+        _credentials_cache[data_dir] = credentials
+        return credentials
@@ -1,11 +1,55 @@
 import logging
+import sqlite3
 from datetime import datetime
 
+import orjson
 from peewee import *
 from playhouse.sqlite_ext import *
 
 database_proxy = Proxy()
 
+# The default maximum number of host parameters in a single SQLite statement.
+SQLITE_MAX_VARIABLE_NUMBER = 999
+
+INSERT_MESSAGE_SQL = """
+INSERT INTO messages (
+    message_id, thread_id, sender, recipients, labels, subject, body, size,
+    timestamp, is_read, is_outgoing, last_indexed
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (message_id) DO UPDATE SET
+    thread_id = excluded.thread_id,
+    sender = excluded.sender,
+    recipients = excluded.recipients,
+    labels = excluded.labels,
+    subject = excluded.subject,
+    body = COALESCE(excluded.body, body),
+    size = excluded.size,
+    timestamp = excluded.timestamp,
+    is_read = excluded.is_read,
+    is_outgoing = excluded.is_outgoing,
+    last_indexed = excluded.last_indexed
+"""
+
+# MIN and MAX in separate subqueries, as SQLite only reads a single aggregate
+# directly from the index and would scan it otherwise.
+INDEXED_RANGE_SQL = """
+SELECT (SELECT MIN(timestamp) FROM messages), (SELECT MAX(timestamp) FROM messages)
+"""
+
+
+def json_dumps(value) -> str:
+    """
+    Serializes a value to a JSON string using orjson.
+
+    Args:
+        value: The value to serialize.
+
+    Returns:
+        str: The JSON string.
+    """
+
+    return orjson.dumps(value).decode("utf-8")
+
 
 class Message(Model):
     """
@@ -32,13 +76,13 @@ class Message(Model):
 
     message_id = TextField(unique=True)
     thread_id = TextField()
-    sender = JSONField()
-    recipients = JSONField()
-    labels = JSONField()
+    sender = JSONField(json_dumps=json_dumps, json_loads=orjson.loads)
+    recipients = JSONField(json_dumps=json_dumps, json_loads=orjson.loads)
+    labels = JSONField(json_dumps=json_dumps, json_loads=orjson.loads)
     subject = TextField(null=True)
     body = TextField(null=True)
     size = IntegerField()
-    timestamp = DateTimeField()
+    timestamp = DateTimeField(index=True)
     is_read = BooleanField()
     is_outgoing = BooleanField()
     last_indexed = DateTimeField()
@@ -48,6 +92,27 @@ class Message(Model):
         db_table = "messages"
 
 
+class State(Model):
+    """
+    Represents a value kept between syncs, like the Gmail history ID of the last sync.
+
+    Attributes:
+        key (TextField): The name of the value.
+        value (TextField): The value.
+
+    Meta:
+        database (Database): The database connection to use.
+        db_table (str): The name of the database table for storing the values.
+    """
+
+    key = TextField(primary_key=True)
+    value = TextField()
+
+    class Meta:
+        database = database_proxy
+        db_table = "state"
+
+
 def init(data_dir: str, enable_logging=False) -> SqliteDatabase:
     """
     Initialize the database for the given data_dir. The database is stored in <data_dir>/messages.db.
@@ -59,9 +124,19 @@ def init(data_dir: str, enable_logging=False) -> SqliteDatabase:
     Returns:
         SqliteDatabase: The initialized database object.
     """
-    db = SqliteDatabase(f"{data_dir}/messages.db")
+    db = SqliteDatabase(
+        f"{data_dir}/messages.db",
+        pragmas={
+            "journal_mode": "wal",
+            "synchronous": 1,  # NORMAL
+            "cache_size": -64000,  # 64 MB
+            "temp_store": 2,  # MEMORY
+            "mmap_size": 268435456,  # 256 MB
+            "wal_autocheckpoint": 10000,
+        },
+    )
     database_proxy.initialize(db)
-    db.create_tables([Message])
+    db.create_tables([Message, State])
 
     if enable_logging:
         logger = logging.getLogger("peewee")
@@ -79,65 +154,122 @@ def create_message(msg: Message):
         msg (Message): The message to save.
     """
 
-    last_indexed = datetime.now()
-    Message.insert(
-        message_id=msg.id,
-        thread_id=msg.thread_id,
-        sender=msg.sender,
-        recipients=msg.recipients,
-        labels=msg.labels,
-        subject=msg.subject,
-        body=msg.body,
-        size=msg.size,
-        timestamp=msg.timestamp,
-        is_read=msg.is_read,
-        is_outgoing=msg.is_outgoing,
-        last_indexed=last_indexed,
-    ).on_conflict(
-        conflict_target=[Message.message_id],
-        preserve=[
-            Message.thread_id,
-            Message.sender,
-            Message.recipients,
-            Message.subject,
-            Message.body,
-            Message.size,
-            Message.timestamp,
-            Message.is_outgoing,
-        ],
-        update={
-            Message.is_read: msg.is_read,
-            Message.last_indexed: last_indexed,
-            Message.labels: msg.labels,
-        },
-    ).execute()
+    create_messages([msg])
 
 
-def last_indexed() -> datetime:
+def create_messages(msgs: list, last_indexed: datetime = None) -> None:
     """
-    Returns the timestamp of the last indexed message.
+    Saves a batch of messages to the database within a single transaction.
+
+    The rows are written with a single prepared statement through the sqlite3 driver
+    instead of peewee, as this is the hot path of every sync.
+
+    Args:
+        msgs (list): The messages to save.
+        last_indexed (datetime, optional): When the messages were indexed. Defaults to now.
+    """
+
+    if not msgs:
+        return
+
+    if last_indexed is None:
+        last_indexed = datetime.now()
+    last_indexed = last_indexed.isoformat(" ")
+    rows = [
+        (
+            msg.id,
+            msg.thread_id,
+            json_dumps(msg.sender),
+            json_dumps(msg.recipients),
+            json_dumps(msg.labels),
+            msg.subject,
+            msg.body,
+            msg.size,
+            msg.timestamp.isoformat(" ") if msg.timestamp else None,
+            msg.is_read,
+            msg.is_outgoing,
+            last_indexed,
+        )
+        for msg in msgs
+    ]
+
+    try:
+        with database_proxy.atomic():
+            database_proxy.cursor().executemany(INSERT_MESSAGE_SQL, rows)
+    except sqlite3.IntegrityError as e:
+        # Raise peewee's error, like peewee's own queries do.
+        raise IntegrityError(*e.args) from e
+
+
+def existing_message_ids(message_ids: list) -> set:
+    """
+    Returns which of the given message IDs are already stored in the database.
+
+    Args:
+        message_ids (list): The message IDs to look up.
 
     Returns:
-        datetime: The timestamp of the last indexed message.
+        set: The message IDs that are already stored.
     """
 
-    msg = Message.select().order_by(Message.timestamp.desc()).first()
-    if msg:
-        return datetime.fromisoformat(msg.timestamp)
+    existing = set()
+    for i in range(0, len(message_ids), SQLITE_MAX_VARIABLE_NUMBER):
+        query = (
+            Message.select(Message.message_id)
+            .where(
+                Message.message_id.in_(message_ids[i : i + SQLITE_MAX_VARIABLE_NUMBER])
+            )
+            .tuples()
+        )
+        existing.update(message_id for (message_id,) in query)
+
+    return existing
+
+
+def indexed_range() -> tuple:
+    """
+    Returns the timestamps of the first and the last indexed message. Both are read
+    from the timestamp index with a single query.
+
+    Returns:
+        tuple: The first and the last timestamp, both None if no message is indexed.
+    """
+
+    first, last = database_proxy.execute_sql(INDEXED_RANGE_SQL).fetchone()
+    if first and last:
+        return datetime.fromisoformat(first), datetime.fromisoformat(last)
     else:
-        return None
+        return None, None
 
 
-def first_indexed() -> datetime:
+def get_state(key: str) -> str:
     """
-    Returns the timestamp of the first indexed message.
+    Returns a value kept between syncs.
+
+    Args:
+        key (str): The name of the value.
 
     Returns:
-        datetime: The timestamp of the first indexed message.
+        str: The value or None if it is not set.
     """
 
-    msg = Message.select().order_by(Message.timestamp.asc()).first()
-    if msg:
-        return datetime.fromisoformat(msg.timestamp)
+    state = State.get_or_none(State.key == key)
+    if state:
+        return state.value
     else:
         return None
+
+
+def set_state(key: str, value: str) -> None:
+    """
+    Stores a value kept between syncs.
+
+    Args:
+        key (str): The name of the value.
+        value (str): The value to store.
+
+    Returns:
+        None
+    """
+
+    State.replace(key=key, value=value).execute()
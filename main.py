@@ -37,6 +37,17 @@ if __name__ == "__main__":
         "--message-id",
         help="The ID of the message to sync",
     )
+    parser.add_argument(
+        "--metadata-only",
+        help="Only fetch the labels and headers of messages, but not their bodies",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--workers",
+        help="The number of worker processes fetching messages",
+        type=int,
+        default=sync.DEFAULT_WORKERS,
+    )
 
     args = parser.parse_args()
 
@@ -45,11 +56,18 @@ if __name__ == "__main__":
 
     db_conn = db.init(args.data_dir)
     if args.command == "sync":
-        sync.all_messages(credentials, full_sync=args.full_sync)
+        sync.all_messages(
+            credentials,
+            full_sync=args.full_sync,
+            num_workers=args.workers,
+            metadata_only=args.metadata_only,
+        )
     elif args.command == "sync-message":
         if args.message_id is None:
             print("Please provide a message ID")
             sys.exit(1)
-        sync.single_message(credentials, args.message_id)
+        sync.single_message(
+            credentials, args.message_id, metadata_only=args.metadata_only
+        )
 
     db_conn.close()
@@ -1,10 +1,62 @@
 import base64
-from email.utils import parseaddr, parsedate_to_datetime
+import binascii
+import re
+from datetime import datetime, timedelta, timezone
+from email.utils import getaddresses, parseaddr, parsedate_to_datetime
+from functools import lru_cache
 
 from bs4 import BeautifulSoup
+from lxml import etree
+from lxml import html as lxml_html
+
+# The MIME types of parts that can hold the body of a message.
+BODY_MIME_TYPES = frozenset(("text/plain", "text/html"))
+
+# The number of distinct address headers whose parsed form is kept.
+ADDRESS_CACHE_SIZE = 1 << 15
+
+# Maps the URL-safe base64 alphabet used by Gmail to the standard one.
+URLSAFE_TRANS = bytes.maketrans(b"-_", b"+/")
+
+# libxml2 keeps no state between documents, so a single parser is reused.
+HTML_PARSER = lxml_html.HTMLParser(encoding="utf-8")
+
+# The common shape of Date headers, e.g. "Wed, 12 Oct 2022 18:42:31 +0200".
+DATE_RE = re.compile(
+    r"(?:[A-Za-z]{3},\s*)?(\d{1,2})\s+([A-Za-z]{3})\s+(\d{4})\s+"
+    r"(\d{2}):(\d{2}):(\d{2})\s+([+-])(\d{2})(\d{2})(?:\s+\([^()]*\))?\s*"
+)
+MONTHS = {
+    "jan": 1,
+    "feb": 2,
+    "mar": 3,
+    "apr": 4,
+    "may": 5,
+    "jun": 6,
+    "jul": 7,
+    "aug": 8,
+    "sep": 9,
+    "oct": 10,
+    "nov": 11,
+    "dec": 12,
+}
 
 
 class Message:
+    __slots__ = (
+        "id",
+        "thread_id",
+        "sender",
+        "recipients",
+        "labels",
+        "subject",
+        "body",
+        "size",
+        "timestamp",
+        "is_read",
+        "is_outgoing",
+    )
+
     def __init__(self):
         self.id = None
         self.thread_id = None
@@ -46,48 +98,95 @@ class Message:
             list: The parsed email addresses.
         """
 
-        parsed_addresses = []
-        for address in addresses.split(","):
-            name, email = parseaddr(address)
-            if len(email) > 0:
-                parsed_addresses.append({"email": email.lower(), "name": name})
-
-        return parsed_addresses
+        return [
+            {"email": email, "name": name} for name, email in split_addresses(addresses)
+        ]
 
-    def decode_body(self, part) -> str:
+    def decode_body(self, part: dict) -> bytes:
         """
-        Decode the body of a message part.
+        Decode the body data of a message part.
 
         Args:
             part (dict): The message part to decode.
 
         Returns:
-            str: The decoded body of the message part.
+            bytes: The decoded body of the message part.
+        """
+
+        data = part["body"]["data"]
+        try:
+            # Extra padding is ignored, so this also decodes unpadded data.
+            encoded = data.encode("ascii").translate(URLSAFE_TRANS)
+            return binascii.a2b_base64(encoded + b"==")
+        except (binascii.Error, UnicodeEncodeError):
+            return base64.urlsafe_b64decode(data)
+
+    def extract_body(self, payload: dict) -> str:
         """
+        Extract the body of a message. The multipart containers of the MIME tree are
+        walked iteratively and the first text/plain part is preferred over the first
+        text/html part. Only HTML bodies are converted to plain text.
 
-        if "data" in part["body"]:
-            return base64.urlsafe_b64decode(part["body"]["data"]).decode("utf-8")
-        elif "parts" in part:
-            for subpart in part["parts"]:
-                decoded_body = self.decode_body(subpart)
-                if decoded_body:
-                    return decoded_body
+        Args:
+            payload (dict): The payload of the message.
 
-        return ""
+        Returns:
+            str: The extracted body or None if the message has no body.
+        """
 
-    def html2text(self, html: str) -> str:
+        html_part = None
+        stack = [payload]
+        while stack:
+            part = stack.pop()
+            mime_type = part.get("mimeType", "")
+            if mime_type.startswith("multipart/"):
+                # Only containers can hold the body, attached messages are skipped.
+                stack.extend(reversed(part.get("parts", [])))
+            elif (
+                mime_type in BODY_MIME_TYPES
+                and "data" in part.get("body", {})
+                and not part.get("filename")
+            ):
+                if mime_type == "text/plain":
+                    return self.decode_body(part).decode("utf-8", "replace")
+                if html_part is None:
+                    html_part = part
+
+        # Single part messages of any other type are converted like HTML.
+        if html_part is None and "data" in payload.get("body", {}):
+            html_part = payload
+
+        if html_part is not None:
+            return self.html2text(self.decode_body(html_part))
+
+        return None
+
+    def html2text(self, html: bytes) -> str:
         """
-        Convert HTML to plain text.
+        Convert UTF-8 encoded HTML to plain text. The bytes are handed to the parser
+        as they are, without decoding them to a string first.
 
         Args:
-            html (str): The HTML to convert.
+            html (bytes): The HTML to convert.
 
         Returns:
             str: The converted HTML.
         """
 
-        soup = BeautifulSoup(html, features="html.parser")
-        return soup.get_text()
+        # Without any markup or entities there is nothing to convert.
+        if b"<" not in html and b"&" not in html:
+            return html.decode("utf-8", "replace")
+
+        try:
+            doc = lxml_html.fromstring(html, parser=HTML_PARSER)
+        except etree.ParserError:
+            # lxml rejects documents without any content.
+            soup = BeautifulSoup(html, features="html.parser", from_encoding="utf-8")
+            return soup.get_text()
+
+        # Like BeautifulSoup, leave out stylesheets and scripts, but keep their tails.
+        etree.strip_elements(doc, "script", "style", with_tail=False)
+        return doc.text_content()
 
     def parse(self, msg: dict, labels: dict) -> None:
         """
@@ -105,52 +204,189 @@ class Message:
         self.thread_id = msg["threadId"]
         self.size = msg["sizeEstimate"]
 
-        for header in msg["payload"]["headers"]:
-            name = header["name"].lower()
-            value = header["value"]
-            if name == "from":
-                addr = parseaddr(value)
-                self.sender = {"name": addr[0], "email": addr[1]}
-            elif name == "to":
-                self.recipients["to"] = self.parse_addresses(value)
-            elif name == "cc":
-                self.recipients["cc"] = self.parse_addresses(value)
-            elif name == "bcc":
-                self.recipients["bcc"] = self.parse_addresses(value)
-            elif name == "subject":
-                self.subject = value
-            elif name == "date":
-                self.timestamp = parsedate_to_datetime(value)
+        payload = msg["payload"]
+
+        # Bind the handler lookup once, as it runs for every header.
+        get_handler = HEADER_HANDLERS.get
+        for header in payload["headers"]:
+            handler = get_handler(header["name"].lower())
+            if handler:
+                handler(self, header["value"])
 
         # Labels
-        if "labelIds" in msg:
-            for l in msg["labelIds"]:
-                self.labels.append(labels[l])
-
-            self.is_read = "UNREAD" not in msg["labelIds"]
-            self.is_outgoing = "SENT" in msg["labelIds"]
-
-        # Extract body
-        # For non multipart messages, use the body from the message directly.
-        if "body" in msg["payload"]:
-            if "data" in msg["payload"]["body"]:
-                self.body = base64.urlsafe_b64decode(
-                    msg["payload"]["body"]["data"]
-                ).decode("utf-8")
-
-                self.body = self.html2text(self.body)
-
-        # For multipart messages, get the body from the parts.
-        if "parts" in msg["payload"] and self.body is None:
-            for part in msg["payload"]["parts"]:
-                if (
-                    part["mimeType"] == "text/html"
-                    or part["mimeType"] == "text/plain"
-                    or part["mimeType"] == "multipart/related"
-                    or part["mimeType"] == "multipart/alternative"
-                ):
-                    self.body = self.decode_body(part)
-                    self.body = self.html2text(self.body)
-
-                    if len(self.body) > 0:
-                        break
+        label_ids = msg.get("labelIds")
+        if label_ids is not None:
+            self.labels = [labels[l] for l in label_ids]
+
+            self.is_read = "UNREAD" not in label_ids
+            self.is_outgoing = "SENT" in label_ids
+
+        self.body = self.extract_body(payload)
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def split_addresses(addresses: str) -> tuple:
+    """
+    Splits a list of email addresses into names and lower-cased emails. The same
+    senders and recipients appear on many messages, so the results are cached.
+
+    Args:
+        addresses (str): The list of email addresses to split.
+
+    Returns:
+        tuple: The (name, email) pairs of all addresses with an email.
+    """
+
+    split = []
+    for name, email in getaddresses([addresses]):
+        if len(email) > 0:
+            # Most addresses are already lower-case, so avoid copying them.
+            if not email.islower():
+                email = email.lower()
+            split.append((name, email))
+
+    return tuple(split)
+
+
+# The sender's name and email, cached like split_addresses().
+parse_sender = lru_cache(maxsize=ADDRESS_CACHE_SIZE)(parseaddr)
+
+
+def set_sender(msg: Message, value: str) -> None:
+    """
+    Sets the sender of a message from its From header.
+
+    Args:
+        msg (Message): The message to update.
+        value (str): The value of the From header.
+
+    Returns:
+        None
+    """
+
+    name, email = parse_sender(value)
+    msg.sender = {"name": name, "email": email}
+
+
+def set_to(msg: Message, value: str) -> None:
+    """
+    Sets the To recipients of a message from its To header.
+
+    Args:
+        msg (Message): The message to update.
+        value (str): The value of the To header.
+
+    Returns:
+        None
+    """
+
+    msg.recipients["to"] = msg.parse_addresses(value)
+
+
+def set_cc(msg: Message, value: str) -> None:
+    """
+    Sets the Cc recipients of a message from its Cc header.
+
+    Args:
+        msg (Message): The message to update.
+        value (str): The value of the Cc header.
+
+    Returns:
+        None
+    """
+
+    msg.recipients["cc"] = msg.parse_addresses(value)
+
+
+def set_bcc(msg: Message, value: str) -> None:
+    """
+    Sets the Bcc recipients of a message from its Bcc header.
+
+    Args:
+        msg (Message): The message to update.
+        value (str): The value of the Bcc header.
+
+    Returns:
+        None
+    """
+
+    msg.recipients["bcc"] = msg.parse_addresses(value)
+
+
+def set_subject(msg: Message, value: str) -> None:
+    """
+    Sets the subject of a message from its Subject header.
+
+    Args:
+        msg (Message): The message to update.
+        value (str): The value of the Subject header.
+
+    Returns:
+        None
+    """
+
+    msg.subject = value
+
+
+def set_timestamp(msg: Message, value: str) -> None:
+    """
+    Sets the timestamp of a message from its Date header.
+
+    Args:
+        msg (Message): The message to update.
+        value (str): The value of the Date header.
+
+    Returns:
+        None
+    """
+
+    msg.timestamp = parse_date(value)
+
+
+def parse_date(value: str) -> datetime:
+    """
+    Parses the value of a Date header. The common numeric time zone shape is parsed
+    with a regular expression, everything else is left to parsedate_to_datetime.
+
+    Args:
+        value (str): The value of the Date header.
+
+    Returns:
+        datetime: The parsed date, the same as parsedate_to_datetime would return.
+    """
+
+    match = DATE_RE.fullmatch(value)
+    month = match and MONTHS.get(match.group(2).lower())
+    if month:
+        day, _, year, hour, minute, second, sign, tz_hours, tz_minutes = match.groups()
+        offset = int(tz_hours) * 3600 + int(tz_minutes) * 60
+        try:
+            # -0000 marks an unknown time zone, for which no tzinfo is set.
+            if sign == "-" and offset == 0:
+                tzinfo = None
+            else:
+                tzinfo = timezone(timedelta(seconds=-offset if sign == "-" else offset))
+            return datetime(
+                int(year),
+                month,
+                int(day),
+                int(hour),
+                int(minute),
+                int(second),
+                tzinfo=tzinfo,
+            )
+        except ValueError:
+            pass
+
+    return parsedate_to_datetime(value)
+
+
+# Maps lower-cased header names to the function storing the header on a message.
+HEADER_HANDLERS = {
+    "from": set_sender,
+    "to": set_to,
+    "cc": set_cc,
+    "bcc": set_bcc,
+    "subject": set_subject,
+    "date": set_timestamp,
+}
@@ -1,12 +1,83 @@
+import itertools
+import multiprocessing
+import random
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from datetime import datetime
 from email.utils import parseaddr, parsedate_to_datetime
 
+import google.oauth2.credentials
+import google_auth_httplib2
+import httplib2
+import orjson
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.model import JsonModel
 from peewee import IntegrityError
 
 import db
 import message
 
 MAX_RESULTS = 500
+HTTP_TIMEOUT = 60
+DEFAULT_WORKERS = 4
+# Gmail accepts up to 100 requests per batch, but recommends at most 50.
+FETCH_BATCH_SIZE = 50
+MAX_RETRIES = 3
+RETRY_MAX_DELAY = 32
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Gmail also reports rate limiting as 403 with one of these reasons.
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+# Like the search, which leaves out spam and trash, only store mail outside these.
+SKIPPED_LABELS = frozenset(("SPAM", "TRASH"))
+# How long the label map stored in the database is used before fetching it again.
+LABELS_MAX_AGE = 3600
+# The headers stored by message.Message, requested when fetching metadata only.
+METADATA_HEADERS = ["From", "To", "Cc", "Bcc", "Subject", "Date"]
+
+# Gmail API service and label map of a fetch worker process, set by init_worker().
+worker_service = None
+worker_labels = None
+
+
+class OrjsonModel(JsonModel):
+    """
+    Parses Gmail API responses with orjson instead of the stdlib json module.
+    """
+
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return super().deserialize(content)
+
+        if self._data_wrapper and "data" in body:
+            body = body["data"]
+
+        return body
+
+
+def create_service(credentials):
+    """
+    Builds a Gmail API service on top of a single authorized HTTP connection. The
+    connection is shared by the token refresh and all API requests of the service.
+
+    Args:
+        credentials (object): The credentials object used to authenticate the API requests.
+
+    Returns:
+        object: The Gmail API service object.
+    """
+
+    http = google_auth_httplib2.AuthorizedHttp(
+        credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT)
+    )
+    return build("gmail", "v1", http=http, model=OrjsonModel(), cache_discovery=False)
 
 
 def get_labels(service) -> dict:
@@ -22,19 +93,250 @@ def get_labels(service) -> dict:
 
     # Get all labels
     labels = {}
-    for label in service.users().labels().list(userId="me").execute()["labels"]:
+    request = service.users().labels().list(userId="me")
+    for label in request.execute(num_retries=MAX_RETRIES)["labels"]:
         labels[label["id"]] = label["name"]
 
     return labels
 
 
-def all_messages(credentials, full_sync=False) -> int:
+def get_cached_labels(service) -> dict:
+    """
+    Returns the label map stored by a previous sync if it is recent enough, and
+    otherwise fetches and stores it.
+
+    Args:
+        service (object): The Gmail API service object.
+
+    Returns:
+        dict: A dictionary containing the labels, where the key is the label ID and the value is the label name.
+    """
+
+    state = db.get_state("labels")
+    if state:
+        cached = orjson.loads(state)
+        if time.time() - cached["fetched_at"] < LABELS_MAX_AGE:
+            return cached["labels"]
+
+    return refresh_labels(service)
+
+
+def refresh_labels(service) -> dict:
+    """
+    Fetches the label map and stores it for get_cached_labels().
+
+    Args:
+        service (object): The Gmail API service object.
+
+    Returns:
+        dict: A dictionary containing the labels, where the key is the label ID and the value is the label name.
+    """
+
+    labels = get_labels(service)
+    db.set_state("labels", db.json_dumps({"fetched_at": time.time(), "labels": labels}))
+
+    return labels
+
+
+def get_message(service, message_id: str, metadata_only=False):
+    """
+    Builds the Gmail API request fetching a message.
+
+    Args:
+        service (object): The Gmail API service object.
+        message_id (str): The ID of the message to fetch.
+        metadata_only (bool): Whether to fetch only the labels and headers, but not the body.
+
+    Returns:
+        object: The request fetching the message.
+    """
+
+    if metadata_only:
+        return (
+            service.users()
+            .messages()
+            .get(
+                userId="me",
+                id=message_id,
+                format="metadata",
+                metadataHeaders=METADATA_HEADERS,
+            )
+        )
+
+    return service.users().messages().get(userId="me", id=message_id)
+
+
+def init_worker(credentials_json: str, labels: dict) -> None:
+    """
+    Initializes a fetch worker process with its own Gmail API service.
+
+    Args:
+        credentials_json (str): The serialized credentials used to authenticate the API requests.
+        labels (dict): The label map.
+
+    Returns:
+        None
+    """
+
+    global worker_service, worker_labels
+
+    credentials = google.oauth2.credentials.Credentials.from_authorized_user_info(
+        orjson.loads(credentials_json)
+    )
+    worker_service = create_service(credentials)
+    worker_labels = labels
+
+
+def fetch_messages(message_ids: list, metadata_only=False) -> tuple:
+    """
+    Fetches and parses a batch of messages with a single Gmail batch request. Runs in
+    a fetch worker process. Requests failing with a transient error are retried in a
+    new batch.
+
+    Args:
+        message_ids (list): The IDs of the messages to fetch.
+        metadata_only (bool): Whether to fetch only the labels and headers, but not the body.
+
+    Returns:
+        tuple: The parsed messages and the IDs of the messages that could not be fetched.
+    """
+
+    msgs = []
+    failed_ids = []
+    errors = []
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt > 0:
+            time.sleep(retry_delay(attempt, errors))
+
+        retry_ids = []
+        errors = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                msgs.append(message.Message.from_raw(response, worker_labels))
+            elif is_retryable(exception):
+                retry_ids.append(request_id)
+                errors.append(exception)
+            else:
+                print(
+                    f"Could not get message from Gmail {request_id}: {str(exception)}"
+                )
+                # Deleted messages are gone for good, there is no point in retrying.
+                if not (
+                    isinstance(exception, HttpError) and exception.resp.status == 404
+                ):
+                    failed_ids.append(request_id)
+
+        batch = worker_service.new_batch_http_request(callback=callback)
+        for message_id in message_ids:
+            batch.add(
+                get_message(worker_service, message_id, metadata_only),
+                request_id=message_id,
+            )
+
+        try:
+            batch.execute()
+        except (HttpError, TimeoutError) as e:
+            if not is_retryable(e):
+                raise
+            retry_ids = message_ids
+            errors = [e]
+
+        if not retry_ids:
+            break
+        message_ids = retry_ids
+    else:
+        for message_id in message_ids:
+            print(f"Could not get message from Gmail {message_id}: retries exhausted")
+        failed_ids.extend(message_ids)
+
+    return msgs, failed_ids
+
+
+def is_retryable(exception: Exception) -> bool:
+    """
+    Checks whether a failed Gmail API request is worth retrying.
+
+    Args:
+        exception (Exception): The exception raised by the request.
+
+    Returns:
+        bool: True for timeouts, rate limiting and server errors.
+    """
+
+    if isinstance(exception, HttpError):
+        if exception.resp.status == 403:
+            return any(
+                reason in RATE_LIMIT_REASONS for reason in error_reasons(exception)
+            )
+        return exception.resp.status in RETRY_STATUSES
+
+    return isinstance(exception, TimeoutError)
+
+
+def error_reasons(exception: HttpError) -> list:
+    """
+    Extracts the reasons of a failed Gmail API request from its error details and
+    from the errors listed in the error response.
+
+    Args:
+        exception (HttpError): The exception raised by the request.
+
+    Returns:
+        list: The reasons, like "userRateLimitExceeded".
+    """
+
+    details = []
+    error_details = getattr(exception, "error_details", None)
+    if isinstance(error_details, list):
+        details.extend(error_details)
+    try:
+        details.extend(orjson.loads(exception.content)["error"]["errors"])
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        pass
+
+    return [d["reason"] for d in details if isinstance(d, dict) and "reason" in d]
+
+
+def retry_delay(attempt: int, errors: list) -> float:
+    """
+    Computes how long to wait before retrying failed requests. Honors the longest
+    Retry-After sent by Gmail, and otherwise uses an exponential backoff with full
+    jitter, so that workers do not retry in lockstep.
+
+    Args:
+        attempt (int): The number of the upcoming retry, starting at 1.
+        errors (list): The exceptions of the failed requests.
+
+    Returns:
+        float: The delay in seconds.
+    """
+
+    retry_after = [
+        int(e.resp["retry-after"])
+        for e in errors
+        if isinstance(e, HttpError) and e.resp.get("retry-after", "").isdigit()
+    ]
+    if retry_after:
+        return min(max(retry_after), RETRY_MAX_DELAY)
+
+    return random.uniform(0, min(2**attempt, RETRY_MAX_DELAY))
+
+
+def all_messages(
+    credentials, full_sync=False, num_workers=DEFAULT_WORKERS, metadata_only=False
+) -> int:
     """
     Fetches messages from the Gmail API using the provided credentials.
 
+    The messages are fetched and parsed by a pool of worker processes, while the
+    calling process is the only one writing to the database.
+
     Args:
         credentials (object): The credentials object used to authenticate the API request.
         full_sync (bool): Whether to do a full sync or not.
+        num_workers (int): The number of worker processes fetching messages.
+        metadata_only (bool): Whether to fetch only the labels and headers, but not the body.
 
     Returns:
         int: The number of messages fetched.
@@ -42,76 +344,278 @@ def all_messages(credentials, full_sync=False) -> int:
 
     query = []
     if not full_sync:
-        last = db.last_indexed()
+        first, last = db.indexed_range()
         if last:
             query.append(f"after:{int(last.timestamp())}")
 
-        first = db.first_indexed()
         if first:
             query.append(f"before:{int(first.timestamp())}")
 
-    service = build("gmail", "v1", credentials=credentials)
+    service = create_service(credentials)
 
-    labels = get_labels(service)
+    labels = refresh_labels(service)
+
+    # Take the history ID before listing, so changes during the sync are seen next time.
+    profile = service.users().getProfile(userId="me").execute(num_retries=MAX_RETRIES)
+    history_id = profile["historyId"]
 
-    page_token = None
-    run = True
     total_messages = 0
-    while run:
-        results = (
-            service.users()
-            .messages()
-            .list(
-                userId="me",
-                maxResults=MAX_RESULTS,
-                pageToken=page_token,
-                q=" | ".join(query),
+    failed_ids = []
+    last_indexed = datetime.now()
+    pages = None
+    if not full_sync:
+        pages = list_history_message_ids(service, db.get_state("history_id"))
+    if pages is None:
+        pages = list_message_ids(service, query)
+        if not full_sync:
+            pages = skip_stored(pages)
+
+    # Retry what the last sync could not fetch, as the history will not list it again.
+    retry_ids = db.get_state("failed_message_ids")
+    if retry_ids:
+        pages = itertools.chain([orjson.loads(retry_ids)], pages)
+
+    batches = (
+        page[i : i + FETCH_BATCH_SIZE]
+        for page in pages
+        for i in range(0, len(page), FETCH_BATCH_SIZE)
+    )
+    # Spawn the workers, as forking would copy the page prefetch thread's state.
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(credentials.to_json(), labels),
+    ) as executor:
+        # Keep only a few batches in flight, so memory does not grow with the mailbox.
+        futures = set()
+        for message_ids in batches:
+            futures.add(executor.submit(fetch_messages, message_ids, metadata_only))
+            if len(futures) >= num_workers * 2:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                total_messages = save_fetched(
+                    done, last_indexed, total_messages, failed_ids
+                )
+
+        done, _ = wait(futures)
+        total_messages = save_fetched(done, last_indexed, total_messages, failed_ids)
+
+    # Messages that failed are kept for the next sync, as the history moves past them.
+    db.set_state("failed_message_ids", db.json_dumps(failed_ids))
+    db.set_state("history_id", history_id)
+
+    return total_messages
+
+
+def list_message_ids(service, query: list):
+    """
+    Lists the IDs of all messages matching the query, page by page. The next page is
+    fetched in the background while the IDs of the current page are consumed.
+
+    Args:
+        service (object): The Gmail API service object.
+        query (list): The search terms, of which any has to match.
+
+    Yields:
+        list: The IDs of the messages on a page.
+    """
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(list_messages_page, service, query, None)
+        while future:
+            results = future.result()
+
+            page_token = results.get("nextPageToken")
+            if page_token:
+                future = executor.submit(list_messages_page, service, query, page_token)
+            else:
+                future = None
+
+            yield [m["id"] for m in results.get("messages", [])]
+
+
+def list_history_message_ids(service, start_history_id: str):
+    """
+    Lists the IDs of all messages that were added or relabeled since the given
+    history ID. Unlike searching the mailbox, this only costs as many requests as
+    there were changes. Messages in spam or trash are left out unless they are
+    already stored, so the history stores the same messages as the search.
+
+    Args:
+        service (object): The Gmail API service object.
+        start_history_id (str): The history ID of the last completed sync or None.
+
+    Returns:
+        list: A single page with the IDs of the changed messages, or None if there is
+        no history ID or Gmail no longer keeps the history since it.
+    """
+
+    if not start_history_id:
+        return None
+
+    # The labels of each changed message as of its latest change.
+    message_labels = {}
+    page_token = None
+    while True:
+        try:
+            results = (
+                service.users()
+                .history()
+                .list(
+                    userId="me",
+                    startHistoryId=start_history_id,
+                    historyTypes=["messageAdded", "labelAdded", "labelRemoved"],
+                    maxResults=MAX_RESULTS,
+                    pageToken=page_token,
+                    fields="history(messagesAdded/message(id,labelIds),"
+                    "labelsAdded/message(id,labelIds),"
+                    "labelsRemoved/message(id,labelIds)),nextPageToken",
+                )
+                .execute(num_retries=MAX_RETRIES)
             )
-            .execute()
+        except HttpError as e:
+            if e.resp.status == 404:
+                return None
+            raise
+
+        for history in results.get("history", []):
+            for key in ("messagesAdded", "labelsAdded", "labelsRemoved"):
+                for change in history.get(key, []):
+                    msg = change["message"]
+                    message_labels[msg["id"]] = msg.get("labelIds", [])
+
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            break
+
+    stored = db.existing_message_ids(list(message_labels))
+    return [
+        [
+            message_id
+            for message_id, label_ids in message_labels.items()
+            if message_id in stored or SKIPPED_LABELS.isdisjoint(label_ids)
+        ]
+    ]
+
+
+def skip_stored(pages):
+    """
+    Removes the IDs of messages that are already stored from pages of message IDs.
+
+    Args:
+        pages (iterable): The pages of message IDs.
+
+    Yields:
+        list: The IDs of the messages on a page that are not stored yet.
+    """
+
+    for page in pages:
+        existing = db.existing_message_ids(page)
+        yield [message_id for message_id in page if message_id not in existing]
+
+
+def list_messages_page(service, query: list, page_token: str) -> dict:
+    """
+    Fetches a page of messages matching the query.
+
+    Args:
+        service (object): The Gmail API service object.
+        query (list): The search terms, of which any has to match.
+        page_token (str): The token of the page to fetch or None for the first page.
+
+    Returns:
+        dict: The page containing the message IDs and the token of the next page.
+    """
+
+    return (
+        service.users()
+        .messages()
+        .list(
+            userId="me",
+            maxResults=MAX_RESULTS,
+            pageToken=page_token,
+            q=" | ".join(query),
+            fields="messages/id,nextPageToken",
         )
+        .execute(num_retries=MAX_RETRIES)
+    )
 
-        messages = results.get("messages", [])
 
-        total_messages += len(messages)
-        for i, m in enumerate(messages, start=total_messages - len(messages) + 1):
-            try:
-                raw_msg = (
-                    service.users().messages().get(userId="me", id=m["id"]).execute()
-                )
-                msg = message.Message.from_raw(raw_msg, labels)
-                db.create_message(msg)
+def save_fetched(
+    futures, last_indexed: datetime, total_messages: int, failed_ids: list
+) -> int:
+    """
+    Saves the messages returned by completed fetch futures.
 
-            except IntegrityError as e:
-                print(f"Could not process message {m['id']}: {str(e)}")
-            except TimeoutError as e:
-                print(f"Could not get message from Gmail {m['id']}: {str(e)}")
+    Args:
+        futures (iterable): The completed futures of fetch_messages().
+        last_indexed (datetime): When the messages were indexed.
+        total_messages (int): The number of messages synced so far.
+        failed_ids (list): Collects the IDs of the messages that could not be fetched.
 
-            print(f"Synced message {msg.id} from {msg.timestamp} (Count: {i})")
+    Returns:
+        int: The number of messages synced including the saved ones.
+    """
+
+    for future in futures:
+        msgs, failed = future.result()
+        failed_ids.extend(failed)
+        save_messages(msgs, last_indexed)
 
-        if "nextPageToken" in results:
-            page_token = results["nextPageToken"]
-        else:
-            run = False
+        for msg in msgs:
+            total_messages += 1
+            print(
+                f"Synced message {msg.id} from {msg.timestamp} (Count: {total_messages})"
+            )
 
     return total_messages
 
 
-def single_message(credentials, message_id: str) -> None:
+def save_messages(msgs: list, last_indexed: datetime) -> None:
+    """
+    Saves a batch of messages to the database. If the batch cannot be written as a
+    whole, the messages are saved one by one so that a single bad message does not
+    discard the rest of the batch.
+
+    Args:
+        msgs (list): The messages to save.
+        last_indexed (datetime): When the messages were indexed.
+
+    Returns:
+        None
+    """
+
+    try:
+        db.create_messages(msgs, last_indexed)
+    except IntegrityError:
+        for msg in msgs:
+            try:
+                db.create_messages([msg], last_indexed)
+            except IntegrityError as e:
+                print(f"Could not process message {msg.id}: {str(e)}")
+
+
+def single_message(credentials, message_id: str, metadata_only=False) -> None:
     """
     Syncs a single message from Gmail using the provided credentials and message ID.
 
     Args:
         credentials: The credentials used to authenticate the Gmail API.
         message_id: The ID of the message to fetch.
+        metadata_only: Whether to fetch only the labels and headers, but not the body.
 
     Returns:
         None
     """
 
-    service = build("gmail", "v1", credentials=credentials)
-    labels = get_labels(service)
+    service = create_service(credentials)
+    labels = get_cached_labels(service)
     try:
-        raw_msg = service.users().messages().get(userId="me", id=message_id).execute()
+        request = get_message(service, message_id, metadata_only)
+        raw_msg = request.execute(num_retries=MAX_RETRIES)
+        # A label created since the labels were stored requires fetching them again.
+        if any(l not in labels for l in raw_msg.get("labelIds", [])):
+            labels = refresh_labels(service)
         msg = message.Message.from_raw(raw_msg, labels)
         db.create_message(msg)
     except IntegrityError as e: